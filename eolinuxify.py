@@ -1,13 +1,25 @@
 import os
-import tempfile
 import json
+import tempfile
 import glob
+import functools
+import hashlib
+import re
+import shutil
+import mmap
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from gitignore_parser import parse_gitignore
+from gitignore_parser import parse_gitignore_str
 import click
 import termcolor
 
 
+# A trailing "/**" is removed first and then a trailing "/*", matching at most one of each
+_DIRECTORY_CONTENTS_SUFFIX = re.compile(r"(?:[/\\]\*)?(?:[/\\]\*\*)?\Z")
+
+
 def repair_gitignore_contents(contents):
     """
     Identifies and corrects two simple patterns that indicate that an entire folder should be ignored
@@ -29,94 +41,287 @@ def repair_gitignore_contents(contents):
     node_modules to see if it ignored, just because the user wrote something such as "node_modules/*"
     """
 
-    lines = contents.splitlines()
-    lines = [line.strip() for line in lines]
-    lines = [line for line in lines if not line == ""]
-    lines = [line for line in lines if not line.startswith("#")]
-    lines = [
-        (line[:-3] if line.endswith("/**") or line.endswith("\\**") else line)
-        for line in lines
-    ]
-    lines = [
-        (line[:-2] if line.endswith("/*") or line.endswith("\\*") else line)
-        for line in lines
-    ]
-    return "\n".join(lines)
+    stripped = (line.strip() for line in contents.splitlines())
+    return "\n".join(
+        _DIRECTORY_CONTENTS_SUFFIX.sub("", line)
+        for line in stripped
+        if line != "" and not line.startswith("#")
+    )
+
+
+def compile_gitignore(contents, base_dir):
+    """
+    Compiles (repaired) .gitignore contents into a matcher of absolute paths under base_dir
+    """
+    return parse_gitignore_str(contents, base_dir=base_dir)
+
 
+_ignorer_cache = {}
+_matcher_by_hash = {}
 
-def chain_is_ignored(root, last_dir, previous, current):
-    rp = os.path.relpath(last_dir, root) if os.path.isabs(last_dir) else last_dir
-    if rp == ".":
-        rp = ""
 
-    def f(x):
-        if rp == "":
-            return current(x)
-        return previous(os.path.join(rp, x)) or current(x)
+def load_ignorer(root, abs_dir):
+    """
+    Parses the (repaired) .gitignore of a directory, reusing the compiled matcher if that
+    directory has been parsed before
 
-    return f
+    Patterns are matched relative to the walk root, so .gitignore files with identical bytes
+    (e.g. copied from a template) share a single compiled matcher, looked up by content hash
+    """
+    ignorer = _ignorer_cache.get(abs_dir)
+    if ignorer is None:
+        with open(os.path.join(abs_dir, ".gitignore"), "rb") as f:
+            raw = f.read()
+        key = (hashlib.blake2b(raw, digest_size=16).digest(), root)
+        ignorer = _matcher_by_hash.get(key)
+        if ignorer is None:
+            contents = repair_gitignore_contents(raw.decode("utf-8"))
+            ignorer = compile_gitignore(contents, root)
+            _matcher_by_hash[key] = ignorer
+        _ignorer_cache[abs_dir] = ignorer
+    return ignorer
+
+
+def is_ignored(path, stack):
+    """
+    Checks an absolute path against every .gitignore matcher on the stack
+    """
+    if os.path.basename(path) == ".git":
+        return True
+    for matcher, _ in stack:
+        if matcher(path):
+            return True
+    return False
 
 
 def get_included_files():
     root = os.getcwd()
     result = []
-
-    def recursion(chained=lambda x: x == ".git"):
-        last = os.getcwd()
-        if ".gitignore" in os.listdir():
-            with open(".gitignore") as f:
-                contents = f.read()
-                contents = repair_gitignore_contents(contents)
-            with tempfile.NamedTemporaryFile() as f:
-                f.write(contents.encode("utf-8"))
-                f.flush()
-                ignorer = parse_gitignore(f.name)
-            is_ignored = chain_is_ignored(
-                root,
-                os.getcwd(),
-                chained,
-                lambda x: os.path.basename(x) == ".git"
-                or ignorer(
-                    os.path.join(
-                        os.path.join(os.path.dirname(f.name)), os.path.relpath(x, root)
-                    )
-                ),
-            )
-        else:
-            is_ignored = chain_is_ignored(
-                root, os.getcwd(), chained, lambda x: os.path.basename(x) == ".git"
-            )
-        files = list(os.listdir(os.getcwd()))
-        for file in files:
-            fullpath = os.path.join(os.getcwd(), file)
-            if is_ignored(fullpath):
-                continue
-            if os.path.isdir(fullpath):
-                os.chdir(fullpath)
-                recursion(is_ignored)
-                os.chdir(last)
-            else:
-                result.append(os.path.relpath(fullpath, root))
-
-    recursion()
-    os.chdir(root)
+    ignorer_stacks = {root: []}
+    for dirpath, dirnames, filenames in os.walk(root, topdown=True, followlinks=False):
+        ignorer_stack = ignorer_stacks.pop(dirpath, [])
+        if ".gitignore" in filenames:
+            ignorer_stack = ignorer_stack + [(load_ignorer(root, dirpath), dirpath)]
+        # Pruning in place keeps os.walk from ever listing ignored directories
+        dirnames[:] = [
+            d for d in dirnames
+            if not is_ignored(os.path.join(dirpath, d), ignorer_stack)
+        ]
+        for d in dirnames:
+            ignorer_stacks[os.path.join(dirpath, d)] = ignorer_stack
+        for f in filenames:
+            path = os.path.join(dirpath, f)
+            # FIFOs, sockets, devices and broken symlinks are listed by os.walk as well
+            if not is_ignored(path, ignorer_stack) and os.path.isfile(path):
+                result.append(os.path.relpath(path, root))
     return result
 
 
+SMALL_FILE_SIZE = 65536
+
+
+BINARY_SNIFF_SIZE = 8192
+
+
 def has_any_crlf(root, relpath):
+    """
+    Searches the file for a CRLF
+
+    A file with a NUL byte in its first 8 KiB is treated as binary and never reported,
+    the same heuristic git uses, so binaries are neither scanned in full nor "fixed"
+    Small files are read with a single read call, which is cheaper than setting up a mapping
+    Larger files are searched through a read only memory map, so they are never copied into a
+    bytes object and only the pages up to the first CRLF are faulted in
+    """
     with open(os.path.join(root, relpath), "rb") as f:
-        contents = f.read()
-    if b"\r\n" in contents:
-        return True
-    return False
+        size = os.fstat(f.fileno()).st_size
+        if size < 2:
+            return False
+        if size <= SMALL_FILE_SIZE:
+            contents = f.read()
+            if b"\0" in contents[:BINARY_SNIFF_SIZE]:
+                return False
+            return b"\r\n" in contents
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            if mm.find(b"\0", 0, BINARY_SNIFF_SIZE) != -1:
+                return False
+            return mm.find(b"\r\n") != -1
+
+
+FIX_CHUNK_SIZE = 1024 * 1024
+
+
+def copy_ownership_and_xattrs(src, dst):
+    """
+    Carries over what shutil.copymode does not: the owner, group and extended attributes
+    Anything the current user is not allowed to set is left as it is
+    """
+    st = os.stat(src)
+    if hasattr(os, "chown"):
+        try:
+            os.chown(dst, st.st_uid, st.st_gid)
+        except OSError:
+            pass
+    if hasattr(os, "listxattr"):
+        try:
+            names = os.listxattr(src)
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                os.setxattr(dst, name, os.getxattr(src, name))
+            except OSError:
+                pass
 
 
 def fix_file(root, relpath):
-    with open(os.path.join(root, relpath), "rb") as f:
-        contents = f.read()
-    contents = contents.decode("utf-8").replace("\r\n", "\n").encode("utf-8")
-    with open(os.path.join(root, relpath), "wb") as f:
-        f.write(contents)
+    """
+    Replaces CRLF with LF directly on the bytes of the file, no text decoding is involved
+
+    The file is streamed into a temporary file next to it, which then atomically replaces
+    the original, so an interrupted run never leaves a truncated file behind
+    Symlinks are resolved first so the link itself is kept and its target is rewritten
+    Files with several hard links are copied back over the same inode instead,
+    since replacing one name would split it from the others
+    A CR at the end of a chunk is held back until the next chunk is read,
+    so a CRLF split across chunks is still replaced
+    """
+    real_path = os.path.realpath(os.path.join(root, relpath))
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f".{os.path.basename(real_path)}.",
+        suffix=".eol.tmp",
+        dir=os.path.dirname(real_path),
+    )
+    changed = False
+    try:
+        with open(real_path, "rb") as src, open(fd, "wb") as dst:
+            carry = b""
+            while chunk := src.read(FIX_CHUNK_SIZE):
+                chunk = carry + chunk
+                carry = chunk[-1:] if chunk.endswith(b"\r") else b""
+                if carry:
+                    chunk = chunk[:-1]
+                fixed = chunk.replace(b"\r\n", b"\n")
+                changed = changed or len(fixed) != len(chunk)
+                dst.write(fixed)
+            dst.write(carry)
+        if changed and os.stat(real_path).st_nlink > 1:
+            with open(tmp_path, "rb") as src, open(real_path, "r+b") as dst:
+                shutil.copyfileobj(src, dst, FIX_CHUNK_SIZE)
+                dst.truncate()
+        elif changed:
+            shutil.copymode(real_path, tmp_path)
+            copy_ownership_and_xattrs(real_path, tmp_path)
+            os.replace(tmp_path, real_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+MAX_WORKERS = min(32, (os.cpu_count() or 4) * 4)
+
+
+CRLF_CACHE_FILENAME = "eolinuxify-cache.json"
+CRLF_CACHE_VERSION = 2
+
+
+def get_crlf_cache_path(root):
+    """
+    The cache lives inside the .git directory so it is never picked up as a source file
+    Returns None when root is not the top of a regular git checkout
+    """
+    git_dir = os.path.join(root, ".git")
+    if not os.path.isdir(git_dir):
+        return None
+    return os.path.join(git_dir, CRLF_CACHE_FILENAME)
+
+
+def load_crlf_cache(root):
+    """
+    Returns the cached verdicts, or an empty cache if it is missing, unreadable
+    or was written by a version of the detection logic that gives different verdicts
+    """
+    cache_path = get_crlf_cache_path(root)
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("version") != CRLF_CACHE_VERSION:
+        return {}
+    files = cache.get("files")
+    return files if isinstance(files, dict) else {}
+
+
+def save_crlf_cache(root, files):
+    cache_path = get_crlf_cache_path(root)
+    if cache_path is None:
+        return
+    try:
+        with open(cache_path, "w") as f:
+            json.dump({"version": CRLF_CACHE_VERSION, "files": files}, f)
+    except OSError as e:
+        print(str(e))
+
+
+# Coarse file systems (e.g. FAT) only store modification times to the nearest 2 seconds
+CRLF_CACHE_RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+
+def get_crlf_cache_key(root, relpath, scan_start_ns):
+    """
+    A file whose path, modification time and size are unchanged keeps its previous CRLF verdict
+
+    Returns None for a file modified too close to the start of the scan, since it could be
+    rewritten within the same timestamp tick without its key changing (git's "racy" problem)
+    Such files are always checked and their verdict is not cached
+    Also returns None if the file can not be stat'ed
+    """
+    try:
+        st = os.stat(os.path.join(root, relpath))
+    except OSError:
+        return None
+    if st.st_mtime_ns >= scan_start_ns - CRLF_CACHE_RACY_WINDOW_NS:
+        return None
+    return f"{relpath}|{st.st_mtime_ns}|{st.st_size}"
+
+
+def probe_file(root, relpath):
+    """
+    Thread pool friendly wrapper around has_any_crlf that reports errors instead of raising
+
+    Returns (relpath, verdict), the verdict is None if the file could not be probed
+    """
+    try:
+        return relpath, has_any_crlf(root, relpath)
+    except Exception as e:
+        print(str(e))
+        return relpath, None
+
+
+def get_file_identity(root, relpath):
+    """
+    Symlinks and hard links to the same file share an identity, so it is only fixed once
+    and never rewritten by two workers at the same time
+    """
+    try:
+        st = os.stat(os.path.join(root, relpath))
+    except OSError:
+        return relpath
+    return (st.st_dev, st.st_ino)
+
+
+def try_fix_file(root, relpath):
+    """
+    Thread pool friendly wrapper around fix_file, returns the raised exception or None
+    """
+    try:
+        fix_file(root, relpath)
+    except Exception as e:
+        return e
+    return None
 
 
 def get_config():
@@ -128,22 +333,77 @@ def get_config():
     return config
 
 
-def is_matched_by_glob(root, relpath, relglob_pattern):
+def run_git(root, args):
+    """
+    Runs a git command in root and returns its raw stdout, or None if git is unavailable
+    or the command fails
+    """
+    try:
+        proc = subprocess.run(
+            ["git", *args],
+            cwd=root,
+            capture_output=True,
+        )
+    except OSError:
+        return None
+    if proc.returncode != 0:
+        return None
+    return proc.stdout
+
+
+def get_git_crlf_verdicts(root, relpaths):
+    """
+    Asks git for the working tree line endings of the given files
+
+    "git ls-files --eol" reports a tracked file as w/crlf or w/mixed when it contains CRLF,
+    and as w/lf or w/none when it does not
+    git is run once without pathspecs, since matching many pathspecs against the index is
+    far slower than listing it, and only records for the requested paths are kept
+    Untracked files, files git considers binary (w/-text) and deleted files are left out,
+    so they are checked by reading them instead
+    If git is unavailable or root is not inside a repository, no files are reported
     """
-    Check if any files match a glob pattern within a directory relative to a root directory.
+    if len(relpaths) == 0:
+        return {}
+    stdout = run_git(root, ["ls-files", "--eol", "-z"])
+    if stdout is None:
+        return {}
+    by_git_path = {relpath.replace(os.sep, "/"): relpath for relpath in relpaths}
+    verdicts = {}
+    for record in stdout.decode("utf-8", "surrogateescape").split("\0"):
+        if "\t" not in record:
+            continue
+        info, path = record.split("\t", 1)
+        if path not in by_git_path:
+            continue
+        worktree_eol = next(
+            (field[2:] for field in info.split() if field.startswith("w/")), ""
+        )
+        if worktree_eol in ("crlf", "mixed"):
+            verdicts[by_git_path[path]] = True
+        elif worktree_eol in ("lf", "none"):
+            verdicts[by_git_path[path]] = False
+    return verdicts
+
+
+def get_glob_matches(root, relglob_patterns):
+    """
+    Collect the files matched by any of several glob patterns relative to a root directory.
+
+    Each pattern is expanded once, so checking a file afterwards is a set lookup.
 
     Args:
         root (str): Root directory.
-        relpath (str): Relative path from the root directory.
-        relglob_pattern (str): Glob pattern to match files.
+        relglob_patterns (list[str]): Glob patterns to match files, relative to the root directory.
 
     Returns:
-        bool: True if files are matched by the glob pattern, False otherwise.
+        set[str]: Normalized absolute paths of all matched files.
     """
-    abs_path = os.path.normpath(os.path.join(root, relpath))
-    glob_pattern = os.path.normpath(os.path.join(root, relglob_pattern))
-    matching_files = glob.glob(glob_pattern)
-    return abs_path in (matching_files if matching_files else [])
+    matched = set()
+    for relglob_pattern in relglob_patterns:
+        glob_pattern = os.path.normpath(os.path.join(root, relglob_pattern))
+        matched.update(os.path.normpath(path) for path in glob.glob(glob_pattern))
+    return matched
 
 
 @click.command()
@@ -157,18 +417,32 @@ def main(yes):
     included_files = get_included_files()
     config = get_config()
     exclude = config.get("exclude", [])
-    included_files = [
-        file for file in included_files if not any(
-            is_matched_by_glob(CWD, file, pattern) for pattern in exclude
-        )
-    ]
-    found_crlf = []
-    for file in included_files:
-        try:
-            if has_any_crlf(CWD, file):
-                found_crlf.append(file)
-        except Exception as e:
-            print(str(e))
+    excluded = get_glob_matches(CWD, exclude)
+    if excluded:
+        abs_files = [os.path.normpath(os.path.join(CWD, file)) for file in included_files]
+        included_files = [
+            file for file, abs_file in zip(included_files, abs_files)
+            if abs_file not in excluded
+        ]
+    scan_start_ns = time.time_ns()
+    crlf_cache = load_crlf_cache(CWD)
+    cache_keys = {
+        file: get_crlf_cache_key(CWD, file, scan_start_ns) for file in included_files
+    }
+    verdicts = {
+        file: crlf_cache[key] for file, key in cache_keys.items() if key in crlf_cache
+    }
+    cache_misses = [file for file in included_files if file not in verdicts]
+    verdicts.update(get_git_crlf_verdicts(CWD, cache_misses))
+    unknown_files = [file for file in cache_misses if file not in verdicts]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        verdicts.update(ex.map(functools.partial(probe_file, CWD), unknown_files))
+    save_crlf_cache(CWD, {
+        cache_keys[file]: verdict
+        for file, verdict in verdicts.items()
+        if cache_keys[file] is not None and verdict is not None
+    })
+    found_crlf = [file for file in included_files if verdicts[file]]
     if len(found_crlf) == 0:
         print("All source files have proper line endings (LF), no files to fix")
         exit(0)
@@ -179,13 +453,18 @@ def main(yes):
     if (not yes) and (not click.confirm("Do you want to fix these files?")):
         print("Aborting")
         return
+    identities = {file: get_file_identity(CWD, file) for file in found_crlf}
+    to_fix = {}
+    for file, identity in identities.items():
+        to_fix.setdefault(identity, file)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        errors = dict(zip(
+            to_fix.keys(), ex.map(functools.partial(try_fix_file, CWD), to_fix.values())
+        ))
     for file in found_crlf:
-        try:
-            print(f'Normalizing eol in file "{file}" to LF...', end="")
-            fix_file(CWD, file)
-            print(" done")
-        except Exception as e:
-            print(e)
+        error = errors[identities[file]]
+        print(f'Normalizing eol in file "{file}" to LF...', end="")
+        print(" done" if error is None else error)
     os.chdir(CWD)
 
 